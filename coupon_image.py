@@ -0,0 +1,177 @@
+"""
+Coupon Image Rendering
+
+Pillow rendering for the /coupon endpoint. Kept free of FastAPI and database
+imports so that image_pool workers can load it without the web app; workers
+also re-run the launcher's __main__, so main.py must not be started directly.
+"""
+
+import io
+import math
+from functools import lru_cache
+
+try:
+    from PIL import Image, ImageDraw, ImageFont, features
+    PIL_AVAILABLE = True
+except Exception:  # pillow missing: keep the API up, /coupon answers 503
+    PIL_AVAILABLE = False
+
+COUPON_PREFIX = "WBAU10DIC-"
+
+
+@lru_cache(maxsize=8)
+def _get_font(path: str, size: int):
+    """Load a TrueType font once per (path, size); falls back to the default font"""
+    try:
+        return ImageFont.truetype(path, size)
+    except Exception:
+        return ImageFont.load_default()
+
+
+# Coupon image layout
+RED = (216, 43, 43)  # #D82B2B
+CREAM = (255, 246, 237)  # #FFF6ED
+TEXT = (30, 30, 30)  # #1E1E1E
+
+W, H = 1080, 1350  # Instagram portrait style
+BANNER_H = 220
+CARD_W, CARD_H = W - 160, 520
+CARD_X = 80
+
+TITLE = "Il MIAOBAUCOUPON del mese è arrivato!"
+SUBTITLE_LINES = (
+    "Ottieni il tuo sconto o omaggio esclusivo valido fino al 10 dicembre 2025!",
+    "Mostralo in cassa nel tuo punto vendita MiaoBau preferito e approfittane prima che scada.",
+)
+LABEL = "CODICE COUPON"
+INFO = "Mostra questo coupon alla cassa per ottenere lo sconto/omaggio."
+FOOTER = "Valido fino al 10 dicembre 2025. Uso personale. Promo riservata al canale WhatsApp MiaoBau."
+
+# Card sits below the subtitle lines (50px apart, starting 50px under the banner)
+CARD_Y = BANNER_H + 50 + 50 * len(SUBTITLE_LINES) + 30
+CODE_Y = CARD_Y + 140
+
+
+@lru_cache(maxsize=1)
+def _get_coupon_template():
+    """Render the static part of the coupon once; only the code is stamped per request"""
+    # Cream body background comes from the initial fill
+    img = Image.new("RGB", (W, H), color=CREAM)
+    draw = ImageDraw.Draw(img)
+
+    font_bold = _get_font("arialbd.ttf", 72)
+    font_semibold = _get_font("arialbd.ttf", 36)
+    font_small = _get_font("arial.ttf", 28)
+
+    # Top red banner (rectangle includes its end row; row BANNER_H stays cream)
+    draw.rectangle([(0, 0), (W, BANNER_H - 1)], fill=RED)
+
+    # Draw title on banner
+    tw = draw.textlength(TITLE, font=font_bold)
+    draw.text(((W - tw) / 2, 60), TITLE, font=font_bold, fill=(255, 255, 255))
+
+    # Subtitle
+    y = BANNER_H + 50
+    for line in SUBTITLE_LINES:
+        lw = draw.textlength(line, font=font_semibold)
+        draw.text(((W - lw) / 2, y), line, font=font_semibold, fill=TEXT)
+        y += 50
+
+    # Coupon card
+    draw.rounded_rectangle([(CARD_X, CARD_Y), (CARD_X + CARD_W, CARD_Y + CARD_H)], radius=24, fill=(255, 255, 255))
+
+    # Code label
+    lw = draw.textlength(LABEL, font=font_small)
+    draw.text((CARD_X + (CARD_W - lw) / 2, CARD_Y + 40), LABEL, font=font_small, fill=TEXT)
+
+    # Instruction
+    iw = draw.textlength(INFO, font=font_small)
+    draw.text((CARD_X + (CARD_W - iw) / 2, CARD_Y + 300), INFO, font=font_small, fill=TEXT)
+
+    # Footer note
+    fw = draw.textlength(FOOTER, font=font_small)
+    draw.text(((W - fw) / 2, H - 80), FOOTER, font=font_small, fill=TEXT)
+
+    return img
+
+
+# FreeType positions glyphs in 26.6 fixed point, i.e. 64 sub-pixel steps
+SUBPIXEL_STEPS = 64
+
+
+@lru_cache(maxsize=64)
+def _get_advance(font, text: str) -> float:
+    return font.getlength(text)
+
+
+@lru_cache(maxsize=2048)
+def _get_glyph_mask(font, text: str, phase: float):
+    """Rasterize `text` as draw.text would with the pen at x=phase.
+
+    Returns the "L" mask and the (left, top) of its bounding box relative to
+    the pen origin; glyphs may start left of or above it.
+    """
+    left, top, right, bottom = font.getbbox(text)
+    mask = Image.new("L", (max(math.ceil(right - left + phase), 1), max(bottom - top, 1)), 0)
+    ImageDraw.Draw(mask).text((phase - left, -top), text, font=font, fill=255)
+    return mask, (left, top)
+
+
+def _code_pieces(code: str) -> list:
+    return [COUPON_PREFIX, *code[len(COUPON_PREFIX):]]
+
+
+def _stamp_code(img, code: str, font) -> None:
+    """Paste `code` centred on the card from cached glyph masks, matching draw.text.
+
+    The origin is floored once and every piece is placed at its exact pen offset
+    from there, using a mask rendered at the same sub-pixel phase.
+    """
+    pieces = _code_pieces(code)
+    cw = sum(_get_advance(font, p) for p in pieces)
+    x = CARD_X + (CARD_W - cw) / 2
+    x0 = math.floor(x)
+    offset = x - x0
+    for p in pieces:
+        ix = math.floor(offset)
+        phase = round((offset - ix) * SUBPIXEL_STEPS) / SUBPIXEL_STEPS
+        if phase == 1:
+            ix, phase = ix + 1, 0.0
+        mask, (left, top) = _get_glyph_mask(font, p, phase)
+        img.paste(RED, (x0 + ix + left, CODE_Y + top), mask)
+        offset += _get_advance(font, p)
+
+
+# Output encodings: fmt -> (Pillow format, media type, save options)
+# PNG uses a fast zlib level since the image is mostly flat colour and never stored.
+# WebP is only offered when this Pillow build was compiled with libwebp.
+IMAGE_FORMATS = {
+    "png": ("PNG", "image/png", {"compress_level": 1, "optimize": False}),
+}
+if PIL_AVAILABLE and features.check("webp"):
+    IMAGE_FORMATS["webp"] = ("WEBP", "image/webp", {"quality": 90, "method": 0})
+
+
+def warm_up() -> None:
+    """Render the template and every glyph phase ahead of the first request (image_pool initializer)"""
+    if PIL_AVAILABLE:
+        _get_coupon_template()
+        font_code = _get_font("arialbd.ttf", 84)
+        for p in _code_pieces(COUPON_PREFIX + "0123456789"):
+            _get_advance(font_code, p)
+            for step in range(SUBPIXEL_STEPS):
+                _get_glyph_mask(font_code, p, step / SUBPIXEL_STEPS)
+
+
+def build_coupon_image(code: str, fmt: str = "png") -> bytes:
+    """Render the coupon for `code`; runs inside image_pool, so it only raises plain exceptions"""
+    img = _get_coupon_template().copy()
+
+    # Code text in red, stamped from the glyph atlas
+    _stamp_code(img, code, _get_font("arialbd.ttf", 84))
+
+    # Export to bytes; they are pickled back to the parent process anyway
+    pil_format, _, save_options = IMAGE_FORMATS[fmt]
+    buf = io.BytesIO()
+    img.save(buf, format=pil_format, **save_options)
+    return buf.getvalue()
@@ -1,22 +1,92 @@
 import os
-import io
+import copy
+import time
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
 from datetime import datetime
+from typing import Literal
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import Response, JSONResponse
 from pymongo import ReturnDocument
 
+import coupon_image
+from coupon_image import COUPON_PREFIX, IMAGE_FORMATS
 from database import db, create_document
-from schemas import Coupon
 
-app = FastAPI()
+# Coupon rendering is CPU-bound Pillow work; keep it off the event loop and the GIL.
+# Workers come from a forkserver (never forked from this multi-threaded process)
+# and import coupon_image plus whatever the launcher's __main__ imports at top
+# level, since multiprocessing re-runs it in each worker. That is why main.py has
+# no __main__ block: start it with `uvicorn main:app` (see start_server.sh).
+#
+# Both layers share the CPUs: WEB_CONCURRENCY uvicorn workers (uvicorn reads the same
+# variable) times IMAGE_WORKERS render processes should not exceed os.cpu_count().
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+IMAGE_WORKERS = max(1, int(os.getenv("IMAGE_WORKERS", (os.cpu_count() or 1) // WEB_CONCURRENCY)))
+_image_pool = None
+
+
+def _get_image_pool() -> ProcessPoolExecutor:
+    global _image_pool
+    if _image_pool is None:
+        ctx = multiprocessing.get_context("forkserver")
+        ctx.set_forkserver_preload(["coupon_image"])
+        _image_pool = ProcessPoolExecutor(
+            max_workers=IMAGE_WORKERS,
+            mp_context=ctx,
+            initializer=coupon_image.warm_up,
+        )
+    return _image_pool
+
+
+def _shutdown_image_pool() -> None:
+    global _image_pool
+    if _image_pool is not None:
+        _image_pool.shutdown(wait=False, cancel_futures=True)
+        _image_pool = None
+
+
+async def _render_coupon(code: str, fmt: str) -> bytes:
+    """Render in image_pool; a pool broken by a dead worker is replaced and the render retried once"""
+    loop = asyncio.get_running_loop()
+    pool = _get_image_pool()
+    try:
+        return await loop.run_in_executor(pool, coupon_image.build_coupon_image, code, fmt)
+    except BrokenProcessPool:
+        # Only the first request to see the breakage replaces the pool; the others
+        # retry on that replacement instead of shutting it down again
+        if _image_pool is pool:
+            _shutdown_image_pool()
+        return await loop.run_in_executor(_get_image_pool(), coupon_image.build_coupon_image, code, fmt)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    _shutdown_image_pool()
+    try:
+        _release_sequences()
+    except Exception:
+        pass  # best effort: unreleased numbers only leave a gap
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Comma-separated list, e.g. CORS_ORIGINS=https://shop.example,https://admin.example
+CORS_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "*").split(",") if o.strip()]
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=CORS_ORIGINS,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["content-type"],
+    expose_headers=["Content-Disposition", "X-Coupon-Code"],
 )
 
 
@@ -30,17 +100,36 @@ def hello():
     return {"message": "Hello from the backend API!"}
 
 
+# /test is hit by health probes: env vars are read once and the collection
+# listing is cached for COLLECTIONS_TTL seconds. Connectivity is still checked
+# on every call with a cheap ping, so an outage shows up immediately.
+TEST_RESPONSE = {
+    "backend": "✅ Running",
+    "database": "❌ Not Available",
+    "database_url": None,
+    "database_name": None,
+    "connection_status": "Not Connected",
+    "collections": []
+}
+DATABASE_URL_STATUS = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
+DATABASE_NAME_STATUS = "✅ Set" if os.getenv("DATABASE_NAME") else "❌ Not Set"
+
+COLLECTIONS_TTL = 30
+_collections_cache = {"expires_at": 0.0, "names": []}
+
+
+def _list_collections() -> list:
+    now = time.monotonic()
+    if now >= _collections_cache["expires_at"]:
+        _collections_cache["names"] = db.list_collection_names()[:10]
+        _collections_cache["expires_at"] = now + COLLECTIONS_TTL
+    return _collections_cache["names"]
+
+
 @app.get("/test")
 def test_database():
     """Test endpoint to check if database is available and accessible"""
-    response = {
-        "backend": "✅ Running",
-        "database": "❌ Not Available",
-        "database_url": None,
-        "database_name": None,
-        "connection_status": "Not Connected",
-        "collections": []
-    }
+    response = copy.copy(TEST_RESPONSE)
 
     try:
         if db is not None:
@@ -49,8 +138,8 @@ def test_database():
             response["database_name"] = db.name if hasattr(db, 'name') else "✅ Connected"
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
-                response["collections"] = collections[:10]
+                db.command("ping")
+                response["collections"] = _list_collections()
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
                 response["database"] = f"⚠️  Connected but Error: {str(e)[:50]}"
@@ -60,135 +149,103 @@ def test_database():
     except Exception as e:
         response["database"] = f"❌ Error: {str(e)[:50]}"
 
-    response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
-    response["database_name"] = "✅ Set" if os.getenv("DATABASE_NAME") else "❌ Not Set"
+    response["database_url"] = DATABASE_URL_STATUS
+    response["database_name"] = DATABASE_NAME_STATUS
 
     return response
 
 
 # Helpers
-COUPON_PREFIX = "WBAU10DIC-"
+# Sequence numbers are reserved from Mongo in blocks and handed out locally.
+# Unused numbers are returned on graceful shutdown; a crash just leaves a gap.
+SEQUENCE_CHUNK = 100
+_sequence_lock = threading.Lock()
+_sequence_blocks = {}  # seq_name -> (next value, highest reserved value)
+
+# Lookups are by _id, which MongoDB always indexes. Counter updates keep the
+# default (journaled) write concern: a lost bump would roll the counter back
+# and hand out codes that were already issued. Block reservation already
+# makes these writes rare.
+counters = db["counters"] if db is not None else None
 
 
 def _get_next_sequence(seq_name: str) -> int:
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
-    counters = db["counters"]
-    doc = counters.find_one_and_update(
-        {"_id": seq_name},
-        {"$inc": {"value": 1}},
-        upsert=True,
-        return_document=ReturnDocument.AFTER,
-    )
-    # When upserted first time, value might be None before increment; ensure int
-    value = doc.get("value") or 1
-    return int(value)
-
-
-def _build_coupon_image(code: str) -> bytes:
-    try:
-        from PIL import Image, ImageDraw, ImageFont  # lazy import to avoid startup crash if pillow missing
-    except Exception:
+    with _sequence_lock:
+        next_value, high = _sequence_blocks.get(seq_name, (1, 0))
+        if next_value > high:
+            doc = counters.find_one_and_update(
+                {"_id": seq_name},
+                {"$inc": {"value": SEQUENCE_CHUNK}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+            high = int(doc["value"])
+            next_value = high - SEQUENCE_CHUNK + 1
+        _sequence_blocks[seq_name] = (next_value + 1, high)
+        return next_value
+
+
+def _release_sequences() -> None:
+    """Give unused reserved numbers back, unless another process has reserved past us"""
+    if db is None:
+        return
+    with _sequence_lock:
+        for seq_name, (next_value, high) in _sequence_blocks.items():
+            unused = high - next_value + 1
+            if unused > 0:
+                counters.update_one(
+                    {"_id": seq_name, "value": high},
+                    {"$inc": {"value": -unused}},
+                )
+        _sequence_blocks.clear()
+
+
+def _create_coupon() -> str:
+    """Allocate the next code and persist it; usually a single Mongo round-trip
+    since the sequence is served from a locally reserved block"""
+    seq = _get_next_sequence("coupon")
+    code = f"{COUPON_PREFIX}{seq:06d}"
+
+    # Persist document (plain dict matching schemas.Coupon; skips model validation)
+    doc = {"code": code, "channel": "whatsapp", "redeemed": False}
+    create_document("coupon", doc)
+    return code
+
+
+def _require_image_backend() -> None:
+    if not coupon_image.PIL_AVAILABLE:
         raise HTTPException(status_code=503, detail="Image generator unavailable. Please try again later.")
 
-    # Colors
-    RED = (216, 43, 43)  # #D82B2B
-    CREAM = (255, 246, 237)  # #FFF6ED
-    TEXT = (30, 30, 30)  # #1E1E1E
-
-    # Image size
-    W, H = 1080, 1350  # Instagram portrait style
-    img = Image.new("RGB", (W, H), color=(255, 255, 255))
-
-    draw = ImageDraw.Draw(img)
-
-    # Top red banner
-    banner_h = 220
-    draw.rectangle([(0, 0), (W, banner_h)], fill=RED)
-
-    # Cream body background
-    draw.rectangle([(0, banner_h), (W, H)], fill=CREAM)
-
-    # Title text
-    title = "Il MIAOBAUCOUPON del mese è arrivato!"
-    subtitle = (
-        "Ottieni il tuo sconto o omaggio esclusivo valido fino al 10 dicembre 2025!\n"
-        "Mostralo in cassa nel tuo punto vendita MiaoBau preferito e approfittane prima che scada."
-    )
-
-    # Load fonts (fallback to default if custom not available)
-    try:
-        font_bold = ImageFont.truetype("arialbd.ttf", 72)
-        font_semibold = ImageFont.truetype("arialbd.ttf", 36)
-        font_code = ImageFont.truetype("arialbd.ttf", 84)
-        font_small = ImageFont.truetype("arial.ttf", 28)
-    except Exception:
-        font_bold = ImageFont.load_default()
-        font_semibold = ImageFont.load_default()
-        font_code = ImageFont.load_default()
-        font_small = ImageFont.load_default()
-
-    # Draw title on banner
-    tw, _ = draw.textlength(title, font=font_bold), 0
-    draw.text(((W - tw) / 2, 60), title, font=font_bold, fill=(255, 255, 255))
-
-    # Subtitle
-    y = banner_h + 50
-    for line in subtitle.split("\n"):
-        lw = draw.textlength(line, font=font_semibold)
-        draw.text(((W - lw) / 2, y), line, font=font_semibold, fill=TEXT)
-        y += 50
-
-    # Coupon card
-    card_w, card_h = W - 160, 520
-    card_x, card_y = 80, y + 30
-    draw.rounded_rectangle([(card_x, card_y), (card_x + card_w, card_y + card_h)], radius=24, fill=(255, 255, 255))
-    # Code label
-    label = "CODICE COUPON"
-    lw = draw.textlength(label, font=font_small)
-    draw.text((card_x + (card_w - lw) / 2, card_y + 40), label, font=font_small, fill=TEXT)
-
-    # Code text in red
-    cw = draw.textlength(code, font=font_code)
-    draw.text((card_x + (card_w - cw) / 2, card_y + 140), code, font=font_code, fill=RED)
-
-    # Instruction
-    info = "Mostra questo coupon alla cassa per ottenere lo sconto/omaggio."
-    iw = draw.textlength(info, font=font_small)
-    draw.text((card_x + (card_w - iw) / 2, card_y + 300), info, font=font_small, fill=TEXT)
-
-    # Footer note
-    footer = "Valido fino al 10 dicembre 2025. Uso personale. Promo riservata al canale WhatsApp MiaoBau."
-    fw = draw.textlength(footer, font=font_small)
-    draw.text(((W - fw) / 2, H - 80), footer, font=font_small, fill=TEXT)
-
-    # Export to bytes
-    buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    buf.seek(0)
-    return buf.getvalue()
-
 
 @app.post("/coupon")
-def generate_coupon():
-    """Generate a personalized coupon image (PNG) with a progressive code.
+async def generate_coupon(fmt: Literal["png", "webp"] = "png", image: bool = True):
+    """Generate a personalized coupon image (PNG, or WebP with ?fmt=webp) with a progressive code.
     Code format: WBAU10DIC-XXXXXX
+    With ?image=false only the code is returned, as text/plain, skipping rendering.
     """
     try:
-        seq = _get_next_sequence("coupon")
-        code = f"{COUPON_PREFIX}{seq:06d}"
-
-        # Persist document
-        doc = Coupon(code=code)
-        create_document("coupon", doc)
-
-        # Build image
-        png_bytes = _build_coupon_image(code)
-        filename = f"miabaucoupon_{code}.png"
-
-        return StreamingResponse(
-            io.BytesIO(png_bytes),
-            media_type="image/png",
+        if image:
+            _require_image_backend()
+            # Reject before a code is allocated and persisted
+            if fmt not in IMAGE_FORMATS:
+                raise HTTPException(status_code=400, detail=f"Image format '{fmt}' is not supported by this server.")
+
+        # Blocking pymongo calls run in the default thread pool, in a single hop
+        code = await asyncio.to_thread(_create_coupon)
+
+        if not image:
+            return Response(content=code, media_type="text/plain", headers={"X-Coupon-Code": code})
+
+        # Build image in a worker process
+        content = await _render_coupon(code, fmt)
+        filename = f"miabaucoupon_{code}.{fmt}"
+
+        # A plain Response sends the image in one body message with Content-Length
+        return Response(
+            content=content,
+            media_type=IMAGE_FORMATS[fmt][1],
             headers={
                 "Content-Disposition": f"attachment; filename={filename}",
                 "X-Coupon-Code": code,
@@ -199,8 +256,3 @@ def generate_coupon():
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
-
-if __name__ == "__main__":
-    import uvicorn
-    port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
@@ -15,5 +15,11 @@ mkdir -p logs
 echo "Installing dependencies..."
 pip install -r requirements.txt
 echo "Starting FastAPI server..."
-nohup uvicorn main:app --host 0.0.0.0 --port 8000 --reload > logs/server.log 2>&1 
+if [ -n "$WEB_CONCURRENCY" ]; then
+  # Multi-process serving: uvicorn reads WEB_CONCURRENCY as --workers, and main.py
+  # sizes each worker's image pool from the same variable
+  nohup uvicorn main:app --host 0.0.0.0 --port "${PORT:-8000}" --log-level warning > logs/server.log 2>&1
+else
+  nohup uvicorn main:app --host 0.0.0.0 --port 8000 --reload > logs/server.log 2>&1
+fi
 echo "Server started in background"
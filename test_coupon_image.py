@@ -0,0 +1,77 @@
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+from PIL import ImageChops, ImageDraw, ImageFont
+
+import coupon_image
+
+CODES = ["WBAU10DIC-000001", "WBAU10DIC-123456", "WBAU10DIC-987650"] + [
+    f"WBAU10DIC-{n:06d}" for n in range(0, 1000000, 99991)
+]
+
+
+def _fonts():
+    fonts = [pytest.param(ImageFont.load_default(), id="default")]
+    try:
+        fonts.append(pytest.param(ImageFont.load_default(size=84), id="truetype"))
+    except TypeError:  # Pillow < 10.1 has no scalable default font
+        pass
+    if hasattr(ImageFont, "load_default_imagefont"):
+        fonts.append(pytest.param(ImageFont.load_default_imagefont(), id="bitmap"))
+    return fonts
+
+
+@pytest.mark.parametrize("font", _fonts())
+@pytest.mark.parametrize("code", CODES)
+def test_stamped_code_matches_draw_text(font, code):
+    expected = Image.new("RGB", (coupon_image.W, coupon_image.H), coupon_image.CREAM)
+    cw = ImageDraw.Draw(expected).textlength(code, font=font)
+    ImageDraw.Draw(expected).text(
+        (coupon_image.CARD_X + (coupon_image.CARD_W - cw) / 2, coupon_image.CODE_Y),
+        code,
+        font=font,
+        fill=coupon_image.RED,
+    )
+
+    stamped = Image.new("RGB", (coupon_image.W, coupon_image.H), coupon_image.CREAM)
+    coupon_image._stamp_code(stamped, code, font)
+
+    assert ImageChops.difference(stamped, expected).getbbox() is None
+
+
+@pytest.mark.parametrize("size", [10, 84])
+def test_stamped_code_handles_negative_left_bearing(monkeypatch, size):
+    try:
+        font = ImageFont.load_default(size=size)
+    except TypeError:  # Pillow < 10.1 has no scalable default font
+        pytest.skip("no scalable default font")
+    # ",", "x" and "/" start left of the pen position in the default font
+    prefix = ",x/WBAU-"
+    assert min(font.getbbox(c)[0] for c in prefix) < 0
+    monkeypatch.setattr(coupon_image, "COUPON_PREFIX", prefix)
+
+    for code in (f"{prefix}123456", f"{prefix}908172"):
+        expected = Image.new("RGB", (coupon_image.W, coupon_image.H), coupon_image.CREAM)
+        cw = ImageDraw.Draw(expected).textlength(code, font=font)
+        ImageDraw.Draw(expected).text(
+            (coupon_image.CARD_X + (coupon_image.CARD_W - cw) / 2, coupon_image.CODE_Y),
+            code,
+            font=font,
+            fill=coupon_image.RED,
+        )
+
+        stamped = Image.new("RGB", (coupon_image.W, coupon_image.H), coupon_image.CREAM)
+        coupon_image._stamp_code(stamped, code, font)
+
+        assert ImageChops.difference(stamped, expected).getbbox() is None
+
+
+def test_template_banner_ends_above_body():
+    template = coupon_image._get_coupon_template()
+    assert template.getpixel((0, coupon_image.BANNER_H - 1)) == coupon_image.RED
+    assert template.getpixel((0, coupon_image.BANNER_H)) == coupon_image.CREAM
+
+
+def test_build_coupon_image_is_png():
+    data = coupon_image.build_coupon_image("WBAU10DIC-000042")
+    assert data.startswith(b"\x89PNG")
@@ -0,0 +1,78 @@
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("pymongo")
+
+import main
+
+
+class FakeCounters:
+    """Just enough of a pymongo collection for _get_next_sequence/_release_sequences"""
+
+    def __init__(self, **values):
+        self.values = dict(values)
+        self.reservations = 0
+
+    def _matches(self, filter_dict):
+        seq_name = filter_dict["_id"]
+        if seq_name not in self.values:
+            return False
+        return "value" not in filter_dict or self.values[seq_name] == filter_dict["value"]
+
+    def find_one_and_update(self, filter_dict, update, upsert=False, return_document=None):
+        self.reservations += 1
+        seq_name = filter_dict["_id"]
+        if not self._matches(filter_dict):
+            if not upsert:
+                return None
+            self.values[seq_name] = 0
+        self.values[seq_name] += update["$inc"]["value"]
+        return {"_id": seq_name, "value": self.values[seq_name]}
+
+    def update_one(self, filter_dict, update):
+        if self._matches(filter_dict):
+            self.values[filter_dict["_id"]] += update["$inc"]["value"]
+
+
+@pytest.fixture
+def counters(monkeypatch):
+    fake = FakeCounters()
+    monkeypatch.setattr(main, "db", object())
+    monkeypatch.setattr(main, "counters", fake)
+    monkeypatch.setattr(main, "_sequence_blocks", {})
+    return fake
+
+
+def test_first_reservation_continues_after_old_counter(counters):
+    # The previous allocator bumped by 1 per coupon, so 1..41 are already issued
+    counters.values["coupon"] = 41
+
+    assert main._get_next_sequence("coupon") == 42
+    assert counters.values["coupon"] == 41 + main.SEQUENCE_CHUNK
+
+
+def test_block_boundary_rolls_over_to_next_reservation(counters):
+    issued = [main._get_next_sequence("coupon") for _ in range(main.SEQUENCE_CHUNK + 1)]
+
+    assert issued == list(range(1, main.SEQUENCE_CHUNK + 2))
+    assert counters.reservations == 2
+    assert counters.values["coupon"] == 2 * main.SEQUENCE_CHUNK
+
+
+def test_release_returns_unused_numbers(counters):
+    assert [main._get_next_sequence("coupon") for _ in range(3)] == [1, 2, 3]
+
+    main._release_sequences()
+
+    assert counters.values["coupon"] == 3
+    assert main._get_next_sequence("coupon") == 4
+
+
+def test_release_skipped_when_another_process_reserved_past_us(counters):
+    main._get_next_sequence("coupon")
+    # Another process reserves the following block
+    counters.find_one_and_update({"_id": "coupon"}, {"$inc": {"value": main.SEQUENCE_CHUNK}})
+
+    main._release_sequences()
+
+    assert counters.values["coupon"] == 2 * main.SEQUENCE_CHUNK